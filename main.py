@@ -2,10 +2,16 @@ import yfinance as yf
 import pandas as pd
 import numpy as np
 import scipy.stats as stats
+import matplotlib
+matplotlib.use("Agg")  # Files only, no GUI backend
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import seaborn as sns
 import os
+import warnings
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit, prange
 
 # --- Configuration ---
 TICKERS = {
@@ -18,77 +24,206 @@ END_DATE = "2020-06-30"
 ROLLING_WINDOW = 21
 BASELINE_PERIOD = 2019
 OUTPUT_DIR = "outputs_nse_bse"
+FIGURE_DPI = 150
+# Add ADF / Shapiro-Wilk p-values to the summary table (imports statsmodels; off for speed)
+DIAGNOSTICS = False
+# Input dtype for the rolling kernels (accumulation is always float64). float64 keeps
+# Roll_KS exact; np.float32 halves memory traffic for long/intraday series, but nearby
+# returns collapse into ties and shift the KS statistic, so only opt in at that scale.
+ROLLING_DTYPE = np.float64
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# yf.download keeps module-level state between calls, so downloads are serialised
+DOWNLOAD_LOCK = threading.Lock()
+
+# Online rolling mean / volatility (ddof=1): Welford's update slid by one point per step,
+# adding r[i] and removing r[i-w], so each step is O(1) regardless of window length.
+@njit(cache=True, nogil=True, fastmath=True)
+def rolling_moments(r, w):
+    n = len(r)
+    roll_mean = np.full(n, np.nan)
+    roll_vol = np.full(n, np.nan)
+    if n < w:
+        return roll_mean, roll_vol
+
+    mean = 0.0
+    m2 = 0.0
+    for k in range(w):
+        delta = r[k] - mean
+        mean += delta / (k + 1)
+        m2 += delta * (r[k] - mean)
+    roll_mean[w - 1] = mean
+    roll_vol[w - 1] = np.sqrt(m2 / (w - 1))
+
+    for i in range(w, n):
+        x_in = float(r[i])
+        x_out = float(r[i - w])
+        prev_mean = mean
+        mean += (x_in - x_out) / w
+        m2 += (x_in - x_out) * (x_in - mean + x_out - prev_mean)
+        roll_mean[i] = mean
+        # Guard against tiny negative values from rounding
+        roll_vol[i] = np.sqrt(max(m2, 0.0) / (w - 1))
+
+    return roll_mean, roll_vol
+
+# Rolling mean, volatility and KS distance to the baseline in a single pass.
+# Values are aligned to the window end (first w-1 entries are NaN), like pandas' rolling(w).
+# The window length is ROLLING_WINDOW, read as a global: numba freezes it as a compile-time
+# constant, so the KS loops have a fixed trip count (21) that LLVM can unroll and vectorise.
+# Both engines share this compiled kernel; cache=True lets later runs skip the JIT.
+@njit(cache=True, parallel=True, nogil=True, fastmath=True)
+def rolling_metrics(r, baseline_sorted):
+    w = ROLLING_WINDOW
+    n = len(r)
+    n_base = len(baseline_sorted)
+    roll_mean, roll_vol = rolling_moments(r, w)
+    roll_ks = np.full(n, np.nan)
+
+    if n_base == 0:
+        return roll_mean, roll_vol, roll_ks
+
+    # Baseline CDF just below and at each return. It depends only on the value,
+    # so it is looked up once per observation instead of once per window.
+    cdf_left = np.searchsorted(baseline_sorted, r, side="left") / n_base
+    cdf_right = np.searchsorted(baseline_sorted, r, side="right") / n_base
+
+    # Two-sample KS without sorting the window: the sup of |F_w - F_base| is reached at a
+    # window point, where F_w is just a count of window values <= (or <) that point
+    for end in prange(w - 1, n):
+        start = end - w + 1
+        d = 0.0
+        for a in range(w):
+            x = r[start + a]
+            n_le = 0
+            n_lt = 0
+            for b in range(w):
+                y = r[start + b]
+                if y <= x:
+                    n_le += 1
+                if y < x:
+                    n_lt += 1
+            d = max(d, n_le / w - cdf_right[start + a], cdf_left[start + a] - n_lt / w)
+        roll_ks[end] = d
+
+    return roll_mean, roll_vol, roll_ks
+
 class StructuralBreakEngine:
-    def __init__(self, name, ticker):
+    def __init__(self, name, ticker, diagnostics=False):
         self.name = name
         self.ticker = ticker
+        # Opt-in ADF / Shapiro-Wilk tests for the summary table (statsmodels is only imported then)
+        self.diagnostics = diagnostics
         self.df = None
         self.baseline = None
+        self.sorted_baseline = None
+        self.summary = None
 
     def fetch(self):
-        # Added repair=True for better yfinance data integrity
-        self.df = yf.download(
-            self.ticker,
-            start=START_DATE,
-            end=END_DATE,
-            auto_adjust=True,
-            progress=False
-        )
+        # The date range is fixed, so prices are downloaded once and cached on disk
+        cache_path = f"{OUTPUT_DIR}/{self.name.lower()}_{START_DATE}_{END_DATE}.parquet"
+        if os.path.exists(cache_path):
+            self.df = pd.read_parquet(cache_path)
+        else:
+            # Added repair=True for better yfinance data integrity
+            with DOWNLOAD_LOCK:
+                self.df = yf.download(
+                    self.ticker,
+                    start=START_DATE,
+                    end=END_DATE,
+                    auto_adjust=True,
+                    progress=False
+                )
 
-        # FIXED: Robust handling for yfinance MultiIndex columns
-        if isinstance(self.df.columns, pd.MultiIndex):
-            try:
-                # Try to extract the specific ticker level (Standard yfinance v0.2+)
-                self.df = self.df.xs(self.ticker, axis=1, level=1)
-            except KeyError:
-                # Fallback: flatten the top level if 'xs' fails
-                self.df.columns = self.df.columns.get_level_values(0)
-
-        # Safety check if column exists
-        if "Close" not in self.df.columns:
-            # Sometimes auto_adjust=True returns only 'Close' without caps or just 'Price'
-            # We assume the first column is the closing price if 'Close' is missing
-            self.df.rename(columns={self.df.columns[0]: "Close"}, inplace=True)
+            # FIXED: Robust handling for yfinance MultiIndex columns
+            if isinstance(self.df.columns, pd.MultiIndex):
+                try:
+                    # Try to extract the specific ticker level (Standard yfinance v0.2+)
+                    self.df = self.df.xs(self.ticker, axis=1, level=1)
+                except KeyError:
+                    # Fallback: flatten the top level if 'xs' fails
+                    self.df.columns = self.df.columns.get_level_values(0)
+
+            # Safety check if column exists
+            if "Close" not in self.df.columns:
+                # Sometimes auto_adjust=True returns only 'Close' without caps or just 'Price'
+                # We assume the first column is the closing price if 'Close' is missing
+                self.df.rename(columns={self.df.columns[0]: "Close"}, inplace=True)
+
+            # Never cache a failed (empty) download
+            if not self.df.empty:
+                self.df.to_parquet(cache_path, engine="pyarrow", compression="snappy")
 
         self.df["Log_Return"] = np.log(self.df["Close"] / self.df["Close"].shift(1))
         self.df.dropna(inplace=True)
 
         # Extract Baseline
         self.baseline = self.df.loc[self.df.index.year == BASELINE_PERIOD, "Log_Return"].values
+        # Sorted once here; the rolling KS only ever needs the baseline in sorted order.
+        # Same dtype as the kernel input so baseline days compare equal to themselves.
+        self.sorted_baseline = np.sort(self.baseline.astype(ROLLING_DTYPE, copy=False))
         
         # Error Check: Ensure baseline has data
         if len(self.baseline) < 10:
             print(f"WARNING: Insufficient baseline data for {self.name} in year {BASELINE_PERIOD}")
 
     def compute(self):
-        r = self.df["Log_Return"]
+        # Work on a raw float64 array; results are attached to the DataFrame once at the end
+        r = self.df["Log_Return"].to_numpy(dtype=np.float64, copy=False)
 
-        self.df["Roll_Mean"] = r.rolling(ROLLING_WINDOW).mean()
-        self.df["Roll_Vol"] = r.rolling(ROLLING_WINDOW).std()
+        # Full-sample summary: one describe() pass gives all four moments (bias=False matches pandas)
+        desc = stats.describe(r, bias=False)
+        summary = {
+            "Mean": desc.mean,
+            "Volatility": np.sqrt(desc.variance),
+            "Skewness": desc.skewness,
+            "Excess Kurtosis": desc.kurtosis,
+        }
+        if self.diagnostics:
+            from statsmodels.tsa.stattools import adfuller
+            # Newer statsmodels warns about a future return-type change; only the p-value is used
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", FutureWarning)
+                summary["ADF p-value"] = adfuller(r)[1]
+            summary["Shapiro p-value"] = stats.shapiro(r)[1]
+        self.summary = pd.Series(summary, name=self.name)
 
-        def ks_roll(x):
-            # Check for NaN or insufficient data in window
-            if len(x) < 10 or len(self.baseline) < 10 or np.isnan(x).any():
-                return np.nan
-            return stats.ks_2samp(x, self.baseline)[0]
+        roll_mean, roll_vol, roll_ks = rolling_metrics(r.astype(ROLLING_DTYPE, copy=False), self.sorted_baseline)
 
-        self.df["Roll_KS"] = r.rolling(ROLLING_WINDOW).apply(ks_roll, raw=True)
-        self.df.dropna(inplace=True)
+        # KS against a near-empty baseline is meaningless
+        if len(self.baseline) < 10:
+            roll_ks[:] = np.nan
+
+        rolling = np.column_stack((roll_mean, roll_vol, roll_ks))
+        valid = ~np.isnan(rolling).any(axis=1)
+        rolling = rolling[valid]
 
         # Calculate Z-Scores
         # ddof=1 for sample standard deviation
-        self.df["Z_Mean"] = stats.zscore(self.df["Roll_Mean"], nan_policy='omit')
-        self.df["Z_Vol"] = stats.zscore(self.df["Roll_Vol"], nan_policy='omit')
-        self.df["Z_KS"] = stats.zscore(self.df["Roll_KS"], nan_policy='omit')
+        # Standardised once here for all three metrics; every plot reads the Z_* columns.
+        # Warm-up NaNs are already masked out, so plain NumPy is enough.
+        z = (rolling - rolling.mean(axis=0)) / rolling.std(axis=0, ddof=1)
+
+        metrics = pd.DataFrame(
+            np.hstack((rolling, z)),
+            index=self.df.index[valid],
+            columns=["Roll_Mean", "Roll_Vol", "Roll_KS", "Z_Mean", "Z_Vol", "Z_KS"]
+        )
+        self.df = pd.concat([self.df[valid], metrics], axis=1)
 
-    def plot_dashboard(self):
-        fig = plt.figure(figsize=(18, 10))
-        gs = gridspec.GridSpec(2, 2)
+    # All plots draw onto one shared Figure, which is saved and cleared after each chart
+    # instead of paying matplotlib's per-Figure setup cost every time
+    def plot_all(self, fig):
+        self.plot_dashboard(fig)
+        self.plot_mean_stability(fig)
+        self.plot_ks_only(fig)
 
-        ax1 = plt.subplot(gs[0, :])
+    def plot_dashboard(self, fig):
+        fig.set_size_inches(18, 10)
+        gs = gridspec.GridSpec(2, 2, figure=fig)
+
+        ax1 = fig.add_subplot(gs[0, :])
         ax1.plot(self.df.index, self.df["Z_Vol"], label="Volatility Z", linewidth=1, color='red')
         ax1.plot(self.df.index, self.df["Z_KS"], label="KS Z (Dist Break)", linewidth=1, color='blue')
         ax1.axhline(3, linestyle="--", linewidth=0.8, color='black')
@@ -97,69 +232,87 @@ class StructuralBreakEngine:
         ax1.legend()
         ax1.grid(True, alpha=0.3)
 
-        ax2 = plt.subplot(gs[1, 0])
+        ax2 = fig.add_subplot(gs[1, 0])
         sns.histplot(self.df["Log_Return"], kde=True, ax=ax2, color='purple')
         ax2.set_title(f"{self.name}: Log Return Distribution")
 
-        ax3 = plt.subplot(gs[1, 1])
+        ax3 = fig.add_subplot(gs[1, 1])
         stats.probplot(self.df["Log_Return"], dist="norm", plot=ax3)
         ax3.set_title(f"{self.name}: Q-Q Plot")
 
-        plt.tight_layout()
-        plt.savefig(f"{OUTPUT_DIR}/{self.name.lower()}_dashboard.png", dpi=300)
-        plt.close()
-
-    def plot_mean_stability(self):
-        plt.figure(figsize=(14, 5))
-        plt.plot(self.df.index, self.df["Z_Mean"], linewidth=1, color='green')
-        plt.axhline(3, linestyle="--", linewidth=0.8, color='black')
-        plt.axhline(-3, linestyle="--", linewidth=0.8, color='black')
-        plt.title(f"{self.name}: Rolling Mean Stability")
-        plt.ylabel("Mean Z Score")
-        plt.grid(True, alpha=0.3)
-        plt.tight_layout()
-        plt.savefig(f"{OUTPUT_DIR}/{self.name.lower()}_mean_stability.png", dpi=300)
-        plt.close()
-
-    def plot_ks_only(self):
-        plt.figure(figsize=(14, 5))
-        plt.plot(self.df.index, self.df["Z_KS"], linewidth=1, color='blue')
-        plt.axhline(3, linestyle="--", linewidth=0.8, color='black')
-        plt.title(f"{self.name}: Distributional Breakdown Only")
-        plt.ylabel("KS Z Score")
-        plt.grid(True, alpha=0.3)
-        plt.tight_layout()
-        plt.savefig(f"{OUTPUT_DIR}/{self.name.lower()}_ks_breakdown.png", dpi=300)
-        plt.close()
+        fig.tight_layout()
+        fig.savefig(f"{OUTPUT_DIR}/{self.name.lower()}_dashboard.png", dpi=FIGURE_DPI)
+        fig.clear()
+
+    def plot_mean_stability(self, fig):
+        fig.set_size_inches(14, 5)
+        ax = fig.add_subplot()
+        ax.plot(self.df.index, self.df["Z_Mean"], linewidth=1, color='green')
+        ax.axhline(3, linestyle="--", linewidth=0.8, color='black')
+        ax.axhline(-3, linestyle="--", linewidth=0.8, color='black')
+        ax.set_title(f"{self.name}: Rolling Mean Stability")
+        ax.set_ylabel("Mean Z Score")
+        ax.grid(True, alpha=0.3)
+        fig.tight_layout()
+        fig.savefig(f"{OUTPUT_DIR}/{self.name.lower()}_mean_stability.png", dpi=FIGURE_DPI)
+        fig.clear()
+
+    def plot_ks_only(self, fig):
+        fig.set_size_inches(14, 5)
+        ax = fig.add_subplot()
+        ax.plot(self.df.index, self.df["Z_KS"], linewidth=1, color='blue')
+        ax.axhline(3, linestyle="--", linewidth=0.8, color='black')
+        ax.set_title(f"{self.name}: Distributional Breakdown Only")
+        ax.set_ylabel("KS Z Score")
+        ax.grid(True, alpha=0.3)
+        fig.tight_layout()
+        fig.savefig(f"{OUTPUT_DIR}/{self.name.lower()}_ks_breakdown.png", dpi=FIGURE_DPI)
+        fig.clear()
 
 # --- Execution ---
+def fetch_engine(name, ticker):
+    print(f"Processing {name} ({ticker})...")
+    e = StructuralBreakEngine(name, ticker, diagnostics=DIAGNOSTICS)
+    e.fetch()
+    return e
+
 engines = []
+fig = plt.figure()
 
-for name, ticker in TICKERS.items():
-    print(f"Processing {name} ({ticker})...")
-    try:
-        e = StructuralBreakEngine(name, ticker)
-        e.fetch()
-        e.compute()
-        e.plot_dashboard()
-        e.plot_mean_stability()
-        e.plot_ks_only()
-        engines.append(e)
-    except Exception as err:
-        print(f"Skipping {name} due to error: {err}")
-
-# Comparison Plot
+# Downloads run in worker threads; compute() and plotting stay on the main thread, in
+# TICKERS order, so one ticker's compute overlaps the next ticker's download.
+# The parallel numba kernel must not be launched from a pool thread: under the TBB
+# threading layer (numba's first choice when installed) that hangs at interpreter exit.
+# matplotlib is not thread-safe either.
+with ThreadPoolExecutor(max_workers=len(TICKERS)) as pool:
+    futures = {name: pool.submit(fetch_engine, name, ticker) for name, ticker in TICKERS.items()}
+    for name, future in futures.items():
+        try:
+            e = future.result()
+            e.compute()
+            e.plot_all(fig)
+            engines.append(e)
+        except Exception as err:
+            fig.clear()
+            print(f"Skipping {name} due to error: {err}")
+
+# Summary Table + Comparison Plot
 if engines:
-    plt.figure(figsize=(14, 6))
+    print("\nLog Return Summary:")
+    print(pd.concat([e.summary for e in engines], axis=1).round(4))
+
+    fig.set_size_inches(14, 6)
+    ax = fig.add_subplot()
     for e in engines:
-        plt.plot(e.df.index, e.df["Z_Vol"], label=f"{e.name} Volatility", linewidth=1)
-
-    plt.axhline(3, linestyle="--", linewidth=0.8, color='black')
-    plt.title("NSE vs BSE: Volatility Breakdown Comparison")
-    plt.ylabel("Z Score")
-    plt.legend()
-    plt.grid(True, alpha=0.3)
-    plt.tight_layout()
-    plt.savefig(f"{OUTPUT_DIR}/nse_bse_volatility_comparison.png", dpi=300)
-    plt.close()
+        ax.plot(e.df.index, e.df["Z_Vol"], label=f"{e.name} Volatility", linewidth=1)
+
+    ax.axhline(3, linestyle="--", linewidth=0.8, color='black')
+    ax.set_title("NSE vs BSE: Volatility Breakdown Comparison")
+    ax.set_ylabel("Z Score")
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(f"{OUTPUT_DIR}/nse_bse_volatility_comparison.png", dpi=FIGURE_DPI)
     print("\nProcessing Complete. Check the 'outputs_nse_bse' folder.")
+
+plt.close(fig)